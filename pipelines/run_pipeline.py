@@ -0,0 +1,239 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import datetime
+
+from src.constants import ISO3S, REGIONS
+from src.datasources import codab, floodscan, worldpop
+from src.utils import cluster, cog, database, quantile, sharding
+
+TABLE_NAME = "floodscan_exposure"
+TABLE_NAME_REGIONS = "floodscan_exposure_regions"
+
+# stages that run after all shards are complete, rather than in each shard
+MERGE_STAGES = ["regions", "quantiles"]
+
+# stages, and the stages that must run before them if selected
+STAGES = {
+    "exposure": [],
+    "raster_stats": ["exposure"],
+    "regions": ["raster_stats"],
+    "quantiles": ["regions"],
+}
+
+
+def order_stages(stages):
+    """Order the selected stages so that each runs after its dependencies"""
+    ordered = []
+
+    def visit(stage):
+        if stage in ordered:
+            return
+        for dependency in STAGES[stage]:
+            if dependency in stages:
+                visit(dependency)
+        ordered.append(stage)
+
+    for stage in stages:
+        visit(stage)
+    return ordered
+
+
+def get_iso3s(state):
+    # only the countries in this shard, if sharded
+    if state["units"] is None:
+        return ISO3S
+    return [x for x in ISO3S if x in state["units"]]
+
+
+def shard_files(state, iso3, blob_names, get_date):
+    # only the dates in this shard, if sharded
+    if state["units"] is None:
+        return blob_names
+    return sharding.filter_to_years(blob_names, state["units"][iso3], get_date)
+
+
+def load_pops(state):
+    if "pops" not in state:
+        print("loading WorldPop grids")
+        iso3s = get_iso3s(state)
+        with ThreadPoolExecutor() as executor:
+            state["pops"] = dict(
+                zip(
+                    iso3s,
+                    executor.map(worldpop.load_worldpop_from_blob, iso3s),
+                )
+            )
+    return state["pops"]
+
+
+def load_adms(state):
+    if "adms" not in state:
+        print("loading admin boundaries")
+        iso3s = get_iso3s(state)
+        with ThreadPoolExecutor() as executor:
+            state["adms"] = dict(
+                zip(
+                    iso3s,
+                    executor.map(
+                        lambda x: codab.load_codab_from_blob(x, admin_level=2),
+                        iso3s,
+                    ),
+                )
+            )
+    return state["adms"]
+
+
+def run_exposure(state, args):
+    pops = load_pops(state)
+    fs_raw_files = floodscan.list_floodscan_cogs()
+    # listed once for all countries, and split by country
+    exposure_files = floodscan.group_exposure_cogs(
+        floodscan.list_exposure_cogs()
+    )
+    for iso3 in get_iso3s(state):
+        print(f"Processing {iso3}")
+        floodscan.calculate_flood_exposure_rasters(
+            iso3=iso3,
+            clobber=args.clobber,
+            # when sharded, the years are already set by the shard's units
+            recent=not args.all_dates and state["units"] is None,
+            verbose=args.verbose,
+            pop=pops[iso3],
+            executor=state["encode_executor"],
+            existing_fs_raw_files=shard_files(
+                state, iso3, fs_raw_files, floodscan.get_floodscan_date
+            ),
+            existing_exposure_files=exposure_files.get(iso3, set()),
+        )
+    # exposure COGs have been added, so any listing is now out of date
+    state.pop("exposure_files", None)
+
+
+def run_raster_stats(state, args):
+    adms = load_adms(state)
+    if "exposure_files" not in state:
+        state["exposure_files"] = floodscan.group_exposure_cogs(
+            floodscan.list_exposure_cogs()
+        )
+    database.create_flood_exposure_table(TABLE_NAME, state["engine"])
+    for iso3 in get_iso3s(state):
+        print(f"Processing {iso3}")
+        floodscan.calculate_flood_exposure_rasterstats(
+            iso3=iso3,
+            engine=state["engine"],
+            clobber=args.clobber,
+            verbose=args.verbose,
+            output_table=TABLE_NAME,
+            adm=adms[iso3],
+            existing_exposure_rasters=shard_files(
+                state,
+                iso3,
+                state["exposure_files"].get(iso3, set()),
+                floodscan.get_exposure_date,
+            ),
+        )
+
+
+def run_regions(state, args):
+    database.create_flood_exposure_table(TABLE_NAME_REGIONS, state["engine"])
+    for region in REGIONS:
+        floodscan.calculate_flood_exposure_rasterstats_regions(
+            region=region,
+            engine=state["engine"],
+            output_table=TABLE_NAME_REGIONS,
+        )
+
+
+def run_quantiles(state, args):
+    quantile.update_quantiles(state["engine"])
+
+
+STAGE_FUNCTIONS = {
+    "exposure": run_exposure,
+    "raster_stats": run_raster_stats,
+    "regions": run_regions,
+    "quantiles": run_quantiles,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run pipeline stages in a single process"
+    )
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=list(STAGES),
+        default=list(STAGES),
+        help="Stages to run (default: all)",
+    )
+    parser.add_argument(
+        "--skip",
+        nargs="+",
+        choices=list(STAGES),
+        default=[],
+        help="Stages to skip",
+    )
+    parser.add_argument("--clobber", action="store_true")
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument(
+        "--all-dates",
+        action="store_true",
+        help="Check all Floodscan dates for exposure, not just this year",
+    )
+    parser.add_argument(
+        "--shard",
+        type=str,
+        help="Only process shard i of n (zero-based), in the form i/n. "
+        f"{' and '.join(MERGE_STAGES)} are then skipped, and should be run "
+        "once all shards are complete",
+    )
+    parser.add_argument(
+        "--as-of",
+        type=lambda x: datetime.strptime(x, "%Y-%m-%d"),
+        help="Reference date (YYYY-MM-DD) for assigning shards, which must "
+        "be the same for all shards. Defaults to today",
+    )
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    skip = args.skip + (MERGE_STAGES if args.shard else [])
+    stages = order_stages([x for x in args.stages if x not in skip])
+    print(f"Running stages: {', '.join(stages)}")
+
+    # state shared between stages, loaded once when first needed
+    state = {
+        "engine": database.get_engine(),
+        "units": None,
+    }
+    if args.shard:
+        state["units"] = sharding.get_shard_units(
+            ISO3S,
+            sharding.get_years(all_dates=args.all_dates, as_of=args.as_of),
+            args.shard,
+            worldpop.estimate_grid_size,
+            as_of=args.as_of,
+        )
+    timings = {}
+    with ExitStack() as stack:
+        # one dask cluster and COG encoding pool, shared by all stages and
+        # countries rather than started for each
+        stack.enter_context(cluster.dask_client())
+        state["encode_executor"] = (
+            stack.enter_context(cog.get_encode_executor())
+            if "exposure" in stages
+            else None
+        )
+        for stage in stages:
+            print(f"Running {stage}")
+            stage_start = time.perf_counter()
+            STAGE_FUNCTIONS[stage](state, args)
+            timings[stage] = time.perf_counter() - stage_start
+
+    timings["total"] = time.perf_counter() - start
+    for stage, seconds in timings.items():
+        print(f"{stage}: {seconds:.1f}s")
+
+    print("Done!")
@@ -1,14 +1,55 @@
+import argparse
+from datetime import datetime
+
 from src.constants import ISO3S
-from src.datasources import floodscan
+from src.datasources import floodscan, worldpop
+from src.utils import sharding
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--shard",
+        type=str,
+        help="Only process shard i of n (zero-based), in the form i/n",
+    )
+    parser.add_argument(
+        "--as-of",
+        type=lambda x: datetime.strptime(x, "%Y-%m-%d"),
+        help="Reference date (YYYY-MM-DD) for assigning shards, which must "
+        "be the same for all shards. Defaults to today",
+    )
+    args = parser.parse_args()
 
     recent = True
     clobber = False
     verbose = False
 
-    for iso3 in ISO3S:
+    iso3s = ISO3S
+    fs_raw_files = None
+    if args.shard:
+        fs_raw_files = floodscan.list_floodscan_cogs()
+        units = sharding.get_shard_units(
+            ISO3S,
+            sharding.get_years(all_dates=not recent, as_of=args.as_of),
+            args.shard,
+            worldpop.estimate_grid_size,
+            as_of=args.as_of,
+        )
+        iso3s = [x for x in ISO3S if x in units]
+
+    for iso3 in iso3s:
         print(f"Processing {iso3}")
         floodscan.calculate_flood_exposure_rasters(
-            iso3=iso3, clobber=clobber, recent=recent, verbose=verbose
+            iso3=iso3,
+            clobber=clobber,
+            # when sharded, the years are already set by the shard's units
+            recent=recent and not args.shard,
+            verbose=verbose,
+            existing_fs_raw_files=(
+                sharding.filter_to_years(
+                    fs_raw_files, units[iso3], floodscan.get_floodscan_date
+                )
+                if args.shard
+                else None
+            ),
         )
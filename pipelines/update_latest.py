@@ -0,0 +1,131 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import ocha_stratus as stratus
+
+from src.constants import ISO3S, REGIONS, STAGE
+from src.datasources import codab, floodscan, worldpop
+from src.utils import cluster, cog, database, quantile
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Update exposure, stats and quantiles for a single date"
+    )
+    parser.add_argument(
+        "--date",
+        type=lambda x: datetime.strptime(x, "%Y-%m-%d"),
+        help="Date to process (YYYY-MM-DD). Defaults to latest Floodscan date",
+    )
+    parser.add_argument("--cog-profile", type=str, default="default")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    timings = {}
+    table_name = "floodscan_exposure"
+    table_name_regions = "floodscan_exposure_regions"
+    engine = database.get_engine()
+
+    # load per-country grids and boundaries up front, concurrently
+    stage_start = time.perf_counter()
+    fs_blob_name = floodscan.get_floodscan_blob_for_date(args.date)
+    date = floodscan.get_floodscan_date(fs_blob_name)
+    print(f"Processing {date:%Y-%m-%d} from {fs_blob_name}")
+    with ThreadPoolExecutor() as executor:
+        pops = dict(
+            zip(ISO3S, executor.map(worldpop.load_worldpop_from_blob, ISO3S))
+        )
+        adms = dict(
+            zip(
+                ISO3S,
+                executor.map(
+                    lambda x: codab.load_codab_from_blob(x, admin_level=2),
+                    ISO3S,
+                ),
+            )
+        )
+    timings["load"] = time.perf_counter() - stage_start
+
+    # COGs are encoded in a process pool, and each country's encode and
+    # upload waits in a background thread, so they overlap with the stats
+    # and exposure of the following countries
+    with cluster.dask_client(), cog.get_encode_executor() as encode_executor:
+        # the raw Floodscan COG is only opened once for all countries
+        ds_fs = floodscan.open_floodscan_cog(fs_blob_name)
+        if ds_fs is None:
+            raise ValueError(
+                f"{fs_blob_name} has no recognized SFED band, can't process "
+                f"{date:%Y-%m-%d}"
+            )
+        ds_fs = ds_fs.expand_dims("date")
+
+        database.create_flood_exposure_table(table_name, engine)
+        timings["exposure"] = timings["adm_stats"] = 0
+        with ThreadPoolExecutor() as upload_executor:
+            uploads = []
+            for iso3 in ISO3S:
+                print(f"Processing {iso3}")
+                stage_start = time.perf_counter()
+                exposure = floodscan.calculate_exposure(ds_fs, pops[iso3])
+                exposure = exposure.persist()
+                uploads.append(
+                    upload_executor.submit(
+                        floodscan.upload_exposure_cogs,
+                        exposure,
+                        iso3,
+                        existing_exposure_files=[],
+                        clobber=True,
+                        verbose=False,
+                        executor=encode_executor,
+                        cog_profile=args.cog_profile,
+                    )
+                )
+                timings["exposure"] += time.perf_counter() - stage_start
+
+                # stats are calculated from the in-memory exposure, rather
+                # than reading back the COG that was just uploaded
+                stage_start = time.perf_counter()
+                df_stats = floodscan.calculate_adm_stats(
+                    exposure, adms[iso3], iso3
+                )
+                floodscan.upload_adm_stats(df_stats, engine, table_name)
+                floodscan.update_exposure_tabular(df_stats, iso3)
+                timings["adm_stats"] += time.perf_counter() - stage_start
+
+            # raise any errors from encoding or uploading
+            stage_start = time.perf_counter()
+            for upload in uploads:
+                upload.result()
+            timings["cog_upload_wait"] = time.perf_counter() - stage_start
+
+    stage_start = time.perf_counter()
+    database.create_flood_exposure_table(table_name_regions, engine)
+    for region in REGIONS:
+        floodscan.calculate_flood_exposure_rasterstats_regions(
+            region=region,
+            engine=engine,
+            output_table=table_name_regions,
+            dates=[date],
+        )
+    timings["regions"] = time.perf_counter() - stage_start
+
+    stage_start = time.perf_counter()
+    quantile.update_quantiles(engine, target_date=date)
+    timings["quantiles"] = time.perf_counter() - stage_start
+
+    timings["total"] = time.perf_counter() - start
+    for stage, seconds in timings.items():
+        print(f"{stage}: {seconds:.1f}s")
+
+    # freshness of the dashboard relative to Floodscan ingest
+    fs_modified = (
+        stratus.get_container_client(stage=STAGE, container_name="raster")
+        .get_blob_client(fs_blob_name)
+        .get_blob_properties()
+        .last_modified
+    )
+    latency = datetime.now(timezone.utc) - fs_modified
+    print(f"End-to-end latency since Floodscan ingest: {latency}")
+
+    print("Done!")
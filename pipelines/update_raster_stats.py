@@ -1,20 +1,56 @@
-import ocha_stratus as stratus
+import argparse
+from datetime import datetime
 
-from src.constants import ISO3S, REGIONS, STAGE
-from src.datasources import floodscan
-from src.utils import database
+from src.constants import ISO3S, REGIONS
+from src.datasources import floodscan, worldpop
+from src.utils import database, sharding
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--shard",
+        type=str,
+        help="Only process shard i of n (zero-based), in the form i/n. "
+        "Regions are then skipped, and should be run once all shards are "
+        "complete",
+    )
+    parser.add_argument(
+        "--all-dates",
+        action="store_true",
+        help="When sharding, shard over all years rather than this year",
+    )
+    parser.add_argument(
+        "--as-of",
+        type=lambda x: datetime.strptime(x, "%Y-%m-%d"),
+        help="Reference date (YYYY-MM-DD) for assigning shards, which must "
+        "be the same for all shards. Defaults to today",
+    )
+    args = parser.parse_args()
 
     clobber = False
     verbose = False
-    engine = stratus.get_engine(stage=STAGE, write=True)
+    engine = database.get_engine()
     table_name = "floodscan_exposure"
     table_name_regions = "floodscan_exposure_regions"
 
+    iso3s = ISO3S
+    exposure_files = None
+    if args.shard:
+        exposure_files = floodscan.group_exposure_cogs(
+            floodscan.list_exposure_cogs()
+        )
+        units = sharding.get_shard_units(
+            ISO3S,
+            sharding.get_years(all_dates=args.all_dates, as_of=args.as_of),
+            args.shard,
+            worldpop.estimate_grid_size,
+            as_of=args.as_of,
+        )
+        iso3s = [x for x in ISO3S if x in units]
+
     # updates per iso3
     database.create_flood_exposure_table(table_name, engine)
-    for iso3 in ISO3S:
+    for iso3 in iso3s:
         print(f"Processing {iso3}")
         floodscan.calculate_flood_exposure_rasterstats(
             iso3=iso3,
@@ -22,12 +58,26 @@ if __name__ == "__main__":
             clobber=clobber,
             verbose=verbose,
             output_table=table_name,
+            existing_exposure_rasters=(
+                sharding.filter_to_years(
+                    exposure_files.get(iso3, set()),
+                    units[iso3],
+                    floodscan.get_exposure_date,
+                )
+                if args.shard
+                else None
+            ),
         )
 
-    # updates per region
-    database.create_flood_exposure_table(table_name_regions, engine)
-    for region in REGIONS:
-        print(f"Processing {region['iso3']} region {region['region_number']}")
-        floodscan.calculate_flood_exposure_rasterstats_regions(
-            region=region, engine=engine, output_table=table_name_regions
-        )
+    if args.shard:
+        print("Skipping regions, to be run once all shards are complete")
+    else:
+        # updates per region
+        database.create_flood_exposure_table(table_name_regions, engine)
+        for region in REGIONS:
+            print(
+                f"Processing {region['iso3']} region {region['region_number']}"
+            )
+            floodscan.calculate_flood_exposure_rasterstats_regions(
+                region=region, engine=engine, output_table=table_name_regions
+            )
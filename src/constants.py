@@ -6,6 +6,15 @@ load_dotenv()
 
 STAGE = os.getenv("STAGE")
 
+# comma-separated list of rolling windows (in days) to compute quantiles for,
+# falling back on the single ROLL_WINDOW if not set
+ROLL_WINDOWS = [
+    int(x)
+    for x in (
+        os.getenv("ROLL_WINDOWS") or os.getenv("ROLL_WINDOW") or "1,7,30"
+    ).split(",")
+]
+
 ISO3S = [
     "ner",
     "nga",
@@ -26,6 +35,8 @@ CHD_GREEN = "#1bb580"
 PROJECT_PREFIX = "ds-floodexposure-monitoring"
 FLOODSCAN_COG_FILEPATH = "floodscan/daily/v5/processed"
 FIELDMAPS_BASE_URL = "https://data.fieldmaps.io/cod/originals/{iso3}.shp.zip"
+# CRS of the WorldPop grid, and so of the exposure rasters
+RASTER_CRS = "EPSG:4326"
 
 WORLDPOP_BASE_URL = (
     "https://data.worldpop.org/GIS/Population/"
@@ -1,18 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+
+import geopandas as gpd
 import ocha_stratus as stratus
 import pandas as pd
 import requests
+import shapely
+
+from src.constants import FIELDMAPS_BASE_URL, PROJECT_PREFIX, RASTER_CRS, STAGE
+from src.utils import blob, database
 
-from src.constants import FIELDMAPS_BASE_URL, PROJECT_PREFIX, STAGE
-from src.utils import blob
+BOUNDS_COLS = ["minx", "miny", "maxx", "maxy"]
 
 
-def load_geo_data(iso3s, regions, save_to_database=True):
+def load_geo_data(iso3s, regions, save_to_database=True, max_workers=8):
     """Load geo data from blob storage and save a lookup table to database."""
-    adms = []
-    for iso3 in iso3s:
+
+    def load_adm(iso3):
         print(f"loading {iso3} adm to migrate")
-        gdf_in = load_codab_from_blob(iso3, admin_level=2)
-        adms.append(gdf_in)
+        return load_codab_from_blob(iso3, admin_level=2)
+
+    # loading is mostly waiting on blob storage, so load countries in threads
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        adms = list(executor.map(load_adm, iso3s))
     adm = pd.concat(adms, ignore_index=True)
 
     for adm_level in range(3):
@@ -21,7 +32,7 @@ def load_geo_data(iso3s, regions, save_to_database=True):
             .fillna(adm[f"ADM{adm_level}_EN"])
             .fillna(adm[f"ADM{adm_level}_PT"])
         )
-    adm.drop(columns=["geometry"], inplace=True)
+    adm.drop(columns=["geometry", *BOUNDS_COLS], inplace=True)
     adm.columns = adm.columns.str.lower()
 
     region_dicts = []
@@ -39,13 +50,7 @@ def load_geo_data(iso3s, regions, save_to_database=True):
     df_out = pd.concat([adm, pd.DataFrame(region_dicts)], ignore_index=True)
 
     if save_to_database:
-        df_out.to_sql(
-            "admin_lookup",
-            schema="app",
-            con=stratus.get_engine(STAGE, write=True),
-            if_exists="replace",
-            index=False,
-        )
+        database.update_admin_lookup(df_out, database.get_engine())
 
 
 def get_blob_name(iso3: str):
@@ -53,6 +58,11 @@ def get_blob_name(iso3: str):
     return f"{PROJECT_PREFIX}/raw/codab/{iso3}.shp.zip"
 
 
+def get_parquet_blob_name(iso3: str, admin_level: int):
+    iso3 = iso3.lower()
+    return f"{PROJECT_PREFIX}/processed/codab/{iso3}_adm{admin_level}.parquet"
+
+
 def download_codab_to_blob(iso3: str, clobber: bool = False):
     iso3 = iso3.lower()
     blob_name = get_blob_name(iso3)
@@ -68,11 +78,98 @@ def download_codab_to_blob(iso3: str, clobber: bool = False):
     # Should eventually get this from ocha-stratus
     blob.upload_blob_data(blob_name, response.content, stage=STAGE)
 
+    # derived GeoParquets are now out of date
+    _load_codab.cache_clear()
+    for admin_level in range(3):
+        try:
+            create_codab_parquet(iso3, admin_level)
+        except Exception as e:
+            print(e)
+            print(f"couldn't create adm{admin_level} GeoParquet for {iso3}")
+
+
+def create_codab_parquet(iso3: str, admin_level: int):
+    """
+    Convert a CODAB shapefile to a GeoParquet in blob storage.
+
+    The GeoParquet is reprojected to the raster CRS and includes the bounds of
+    each geometry, so that it can be used directly for clipping rasters.
+
+    Parameters
+    ----------
+    iso3 : str
+        ISO3 code of the country
+    admin_level : int
+        Admin level of the boundaries
 
-def load_codab_from_blob(iso3: str, admin_level: int = 0):
+    Returns
+    -------
+    gpd.GeoDataFrame
+        Boundaries as saved to the GeoParquet
+    """
     iso3 = iso3.lower()
     shapefile = f"{iso3}_adm{admin_level}.shp"
     gdf = stratus.load_shp_from_blob(
         blob_name=get_blob_name(iso3), shapefile=shapefile, stage=STAGE
     )
+    gdf = gdf.to_crs(RASTER_CRS)
+    gdf[BOUNDS_COLS] = gdf.bounds
+    buffer = BytesIO()
+    gdf.to_parquet(buffer, index=False)
+    blob.upload_blob_data(
+        get_parquet_blob_name(iso3, admin_level),
+        buffer.getvalue(),
+        stage=STAGE,
+    )
+    return gdf
+
+
+@lru_cache
+def _load_codab(iso3: str, admin_level: int, simplify_tolerance: float):
+    blob_name = get_parquet_blob_name(iso3, admin_level)
+    if blob_name in stratus.list_container_blobs(
+        name_starts_with=blob_name, stage=STAGE
+    ):
+        data = blob.load_blob_data(blob_name, stage=STAGE)
+        gdf = gpd.read_parquet(BytesIO(data))
+    else:
+        print(f"creating {blob_name}")
+        gdf = create_codab_parquet(iso3, admin_level)
+
+    if simplify_tolerance is not None:
+        # simplify the boundaries as one coverage, so that edges shared by
+        # neighbouring admins are simplified the same way
+        gdf["geometry"] = shapely.coverage_simplify(
+            gdf.geometry.values, simplify_tolerance
+        )
+        gdf[BOUNDS_COLS] = gdf.bounds
     return gdf
+
+
+def load_codab_from_blob(
+    iso3: str, admin_level: int = 0, simplify_tolerance: float = None
+):
+    """
+    Load CODAB boundaries, in the raster CRS.
+
+    Boundaries are read from a GeoParquet derived from the CODAB shapefile
+    (created on first use), and kept in memory for later calls.
+
+    Parameters
+    ----------
+    iso3 : str
+        ISO3 code of the country
+    admin_level : int
+        Admin level of the boundaries
+    simplify_tolerance : float, optional
+        If set, simplify geometries to this tolerance (in CRS units). The
+        boundaries are simplified together as a coverage, so shared edges
+        stay shared, without gaps or overlaps between admins
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        Boundaries, with bounds of each geometry in columns minx, miny, maxx,
+        maxy
+    """
+    return _load_codab(iso3.lower(), admin_level, simplify_tolerance).copy()
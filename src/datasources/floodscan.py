@@ -1,15 +1,24 @@
+import os
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, wait
+from contextlib import nullcontext
 from datetime import datetime
-from typing import Literal
+from functools import lru_cache
+from io import BytesIO
+from typing import Dict, Iterable, List, Literal, Set
 
 import ocha_stratus as stratus
 import pandas as pd
 import xarray as xr
 from sqlalchemy.engine import Engine
-from tqdm.auto import tqdm
 
 from src.constants import FLOODSCAN_COG_FILEPATH, PROJECT_PREFIX, STAGE
 from src.datasources import codab, worldpop
-from src.utils import database
+from src.utils import batching, blob, cluster, cog, database
+
+TABULAR_COLS = ["iso3", "adm_level", "pcode", "valid_date", "sum"]
+TABULAR_ROW_GROUP_SIZE = 10000
+# attempts to update a partition that other runs are also updating
+TABULAR_WRITE_ATTEMPTS = 5
 
 
 def calculate_flood_exposure_rasters(
@@ -17,7 +26,15 @@ def calculate_flood_exposure_rasters(
     clobber: bool = False,
     recent: bool = True,
     verbose: bool = False,
-    batch_size: int = 100,
+    batch_size: int = None,
+    backend: Literal["threads", "distributed"] = cluster.DASK_BACKEND,
+    cluster_kwargs: dict = None,
+    cog_profile: str = "default",
+    encode_workers: int = None,
+    executor: cog.EncodeExecutor = None,
+    pop: xr.DataArray = None,
+    existing_fs_raw_files: List[str] = None,
+    existing_exposure_files: Iterable[str] = None,
 ):
     """
     Calculate flood exposure rasters for a given country.
@@ -33,22 +50,38 @@ def calculate_flood_exposure_rasters(
     verbose: bool
         Whether to print progress of specific dates
     batch_size: int
-        Maximum number of files to process in a single batch (default: 100)
+        Maximum number of files to process in a single batch. By default,
+        based on the size of the country's grid and the memory available
+        (see `batching.get_batch_size`), and halved if a batch runs out of
+        memory
+    backend: Literal["threads", "distributed"]
+        Dask execution backend (see `cluster.dask_client`)
+    cluster_kwargs: dict
+        Worker count, threads per worker, memory limit and spill settings
+        passed to `cluster.dask_client`
+    cog_profile: str
+        Name of COG encoding profile in `cog.COG_PROFILES`
+    encode_workers: int
+        Number of processes for encoding COGs (default: number of cores)
+    executor: cog.EncodeExecutor
+        Already running pool for encoding COGs (e.g. shared between
+        countries), used instead of starting one with `encode_workers`
+    pop: xr.DataArray
+        Already loaded WorldPop grid (loaded from blob if not provided)
+    existing_fs_raw_files: List[str]
+        Already listed raw Floodscan COGs, as from `list_floodscan_cogs`
+    existing_exposure_files: Iterable[str]
+        Already listed exposure COGs for this country, as from
+        `list_exposure_cogs` or `group_exposure_cogs`
 
     Returns
     -------
     """
-    pop = worldpop.load_worldpop_from_blob(iso3)
+    if pop is None:
+        pop = worldpop.load_worldpop_from_blob(iso3)
     # check for existing raw Floodscan rasters
-    existing_fs_raw_files = [
-        x
-        for x in stratus.list_container_blobs(
-            name_starts_with=FLOODSCAN_COG_FILEPATH,
-            container_name="raster",
-            stage=STAGE,
-        )
-        if x.endswith(".tif")
-    ]
+    if existing_fs_raw_files is None:
+        existing_fs_raw_files = list_floodscan_cogs()
 
     # filter to only this year onwards
     if recent:
@@ -60,43 +93,109 @@ def calculate_flood_exposure_rasters(
     else:
         fs_raw_files = existing_fs_raw_files
 
-    # check for existing processed exposure rasters
-    existing_exposure_files = stratus.list_container_blobs(
-        name_starts_with=f"{PROJECT_PREFIX}/processed/flood_exposure/"
-        f"{iso3}",
-        stage=STAGE,
-    )
+    # check for existing processed exposure rasters, as a set since each
+    # date is looked up in it
+    if existing_exposure_files is None:
+        existing_exposure_files = list_exposure_cogs(iso3)
+    existing_exposure_files = set(existing_exposure_files)
 
     # Split files into batches of size batch_size
     total_files = len(fs_raw_files)
     print(f"Total files to process: {total_files}")
+    if batch_size is None:
+        batch_size = batching.get_batch_size(pop.shape, pop.dtype)
+        print(f"Using batch size {batch_size}")
+
+    if executor is None:
+        encode_executor = cog.get_encode_executor(encode_workers)
+    else:
+        encode_executor = nullcontext(executor)
+    with cluster.dask_client(
+        backend, **(cluster_kwargs or {})
+    ), encode_executor as executor:
+        batch_stats = batching.run_in_batches(
+            fs_raw_files,
+            batch_size,
+            lambda current_batch: process_batch_flood_exposure(
+                current_batch,
+                pop,
+                iso3,
+                existing_exposure_files,
+                clobber,
+                verbose,
+                executor=executor,
+                cog_profile=cog_profile,
+            ),
+            verbose=verbose,
+            on_memory_error=executor.restart,
+        )
+    encode_stats = [x for stats in batch_stats for x in stats]
 
-    for batch_start in tqdm(range(0, total_files, batch_size)):
-        batch_end = min(batch_start + batch_size, total_files)
-        current_batch = fs_raw_files[batch_start:batch_end]
+    if encode_stats:
+        print("COG encoding:")
+        print(cog.summarize_encode_stats(encode_stats))
+
+
+def list_floodscan_cogs() -> List[str]:
+    """List all raw Floodscan COGs in blob storage"""
+    return [
+        x
+        for x in stratus.list_container_blobs(
+            name_starts_with=FLOODSCAN_COG_FILEPATH,
+            container_name="raster",
+            stage=STAGE,
+        )
+        if x.endswith(".tif")
+    ]
 
-        if verbose:
-            print(
-                f"""Processing batch {batch_start//batch_size + 1},
-                files {batch_start+1}-{batch_end} of {total_files}"""
-            )
 
-        # Process current batch
-        process_batch_flood_exposure(
-            current_batch, pop, iso3, existing_exposure_files, clobber, verbose
+def list_exposure_cogs(iso3: str = None) -> List[str]:
+    """List exposure COGs in blob storage, for one country or all"""
+    prefix = f"{PROJECT_PREFIX}/processed/flood_exposure/"
+    if iso3 is not None:
+        prefix += f"{iso3}/"
+    return [
+        x
+        for x in stratus.list_container_blobs(
+            name_starts_with=prefix, stage=STAGE
         )
+        if x.endswith(".tif")
+    ]
+
+
+def group_exposure_cogs(blob_names: Iterable[str]) -> Dict[str, Set[str]]:
+    """
+    Group a listing of exposure COGs for all countries by country, so that
+    each country's COGs can be looked up without scanning the others
+    """
+    prefix = f"{PROJECT_PREFIX}/processed/flood_exposure/"
+    grouped = {}
+    for blob_name in blob_names:
+        iso3 = blob_name.removeprefix(prefix).split("/")[0]
+        grouped.setdefault(iso3, set()).add(blob_name)
+    return grouped
 
 
 def process_batch_flood_exposure(
-    file_batch, pop, iso3, existing_exposure_files, clobber, verbose
+    file_batch,
+    pop,
+    iso3,
+    existing_exposure_files,
+    clobber,
+    verbose,
+    executor=None,
+    cog_profile="default",
 ):
-    """Process a batch of files"""
+    """
+    Process a batch of files
+
+    Returns a list of encode stats for each COG, as from
+    `upload_exposure_cogs`.
+    """
     # stack up relevant raw Floodscan rasters for this batch
     das = []
     for blob_name in file_batch:
-        date_in = datetime.strptime(
-            blob_name.split("/")[-1][15:25], "%Y-%m-%d"
-        )
+        date_in = get_floodscan_date(blob_name)
         date_str = date_in.strftime("%Y-%m-%d")
         exposure_blob_name = get_blob_name(
             iso3, "exposure_raster", date=date_str
@@ -105,36 +204,133 @@ def process_batch_flood_exposure(
             if verbose:
                 print(f"already processed for {date_str}, skipping")
             continue
-        da_in = stratus.open_blob_cog(
-            blob_name, container_name="raster", stage=STAGE
-        )
-        long_name = da_in.attrs["long_name"]
-        if long_name == ("SFED", "MFED"):
-            da_in = da_in.isel(band=0)
-        elif long_name == ("MFED", "SFED"):
-            da_in = da_in.isel(band=1)
-        elif long_name == "SFED":
-            da_in = da_in.isel(band=0)
-        else:
-            print(f"unrecognized long_name, skipping {date_in}")
+        da_in = open_floodscan_cog(blob_name)
+        if da_in is None:
             continue
-        da_in = da_in.drop_vars("band")
-        da_in["date"] = date_in
-        da_in = da_in.persist()
         das.append(da_in)
 
     if not das:
         if verbose:
             print("no new floodscan data to process in this batch")
-        return
-    ds_recent = xr.concat(das, dim="date")
+        return []
+    exposure = calculate_exposure(xr.concat(das, dim="date"), pop)
+    return upload_exposure_cogs(
+        exposure,
+        iso3,
+        existing_exposure_files,
+        clobber,
+        verbose,
+        executor=executor,
+        cog_profile=cog_profile,
+    )
+
+
+def get_floodscan_date(blob_name: str) -> datetime:
+    """Get the date of a raw Floodscan COG from its blob name"""
+    return datetime.strptime(blob_name.split("/")[-1][15:25], "%Y-%m-%d")
+
+
+def get_exposure_date(blob_name: str) -> datetime:
+    """Get the date of an exposure COG from its blob name"""
+    return datetime.strptime(blob_name.split("/")[-1][13:23], "%Y-%m-%d")
+
+
+def get_floodscan_blob_for_date(date: datetime = None) -> str:
+    """
+    Get the blob name of the raw Floodscan COG for a given date, or for the
+    latest available date if not provided.
+    """
+    fs_raw_files = list_floodscan_cogs()
+    if date is None:
+        return max(fs_raw_files, key=get_floodscan_date)
+    for blob_name in fs_raw_files:
+        if get_floodscan_date(blob_name) == date:
+            return blob_name
+    raise ValueError(f"no Floodscan data for {date:%Y-%m-%d}")
+
+
+def open_floodscan_cog(blob_name: str):
+    """
+    Open the SFED band of a raw Floodscan COG, with its date as a coordinate.
+
+    Returns None if the bands aren't recognized.
+    """
+    date_in = get_floodscan_date(blob_name)
+    da_in = stratus.open_blob_cog(
+        blob_name, container_name="raster", stage=STAGE
+    )
+    long_name = da_in.attrs["long_name"]
+    if long_name == ("SFED", "MFED"):
+        da_in = da_in.isel(band=0)
+    elif long_name == ("MFED", "SFED"):
+        da_in = da_in.isel(band=1)
+    elif long_name == "SFED":
+        da_in = da_in.isel(band=0)
+    else:
+        print(f"unrecognized long_name, skipping {date_in}")
+        return None
+    da_in = da_in.drop_vars("band")
+    da_in["date"] = date_in
+    return cluster.chunk_to_blocks(da_in).persist()
+
+
+def calculate_exposure(ds_recent: xr.DataArray, pop: xr.DataArray):
+    """
+    Calculate population exposure from Floodscan SFED, with a date dimension
+    """
     # filter to only pixels with flood extent > 5% to reduce noise
     ds_recent_filtered = ds_recent.where(ds_recent >= 0.05)
     # interpolate to Worldpop grid and
     # multiply by population to get exposure
     exposure = ds_recent_filtered.interp_like(pop, method="nearest") * pop
+    # align chunks with the blocks of the output COGs
+    return cluster.chunk_to_blocks(exposure)
+
+
+def upload_exposure_cogs(
+    exposure,
+    iso3,
+    existing_exposure_files,
+    clobber,
+    verbose,
+    executor=None,
+    cog_profile="default",
+    max_pending=None,
+):
+    """
+    Encode exposure rasters as COGs and upload them to blob storage
+
+    COGs are encoded in `executor` (a process pool) if provided, and
+    uploaded as each one is ready. At most `max_pending` dates (default
+    twice the number of cores) are held in memory waiting to be encoded or
+    uploaded at once. Returns a list of encode stats (profile, encode time
+    and size) for each COG.
+    """
+    if max_pending is None:
+        max_pending = 2 * (os.cpu_count() or 1)
+    encode_stats = []
+    pending = {}
 
-    # iterate over dates and upload COGs to blob storage
+    def upload(blob_name, data, encode_time):
+        if verbose:
+            print(f"uploading {blob_name}")
+        blob.upload_blob_data(
+            blob_name, data, stage=STAGE, content_type="image/tiff"
+        )
+        encode_stats.append(
+            {
+                "profile": cog_profile,
+                "encode_time": encode_time,
+                "size": len(data),
+            }
+        )
+
+    def upload_completed(return_when):
+        done, _ = wait(pending, return_when=return_when)
+        for future in done:
+            upload(pending.pop(future), *future.result())
+
+    # iterate over dates and encode COGs, uploading as they are encoded
     for date in exposure.date:
         date_str = str(date.values.astype("datetime64[D]"))
         blob_name = get_blob_name(iso3, "exposure_raster", date=date_str)
@@ -142,11 +338,18 @@ def process_batch_flood_exposure(
             if verbose:
                 print("already processed")
             continue
-        if verbose:
-            print(f"uploading {blob_name}")
-        stratus.upload_cog_to_blob(
-            exposure.sel(date=date), blob_name, stage=STAGE
-        )
+        da_date = exposure.sel(date=date).compute()
+        if executor is None:
+            upload(blob_name, *cog.encode_cog(da_date, cog_profile))
+            continue
+        if len(pending) >= max_pending:
+            upload_completed(FIRST_COMPLETED)
+        future = executor.submit(cog.encode_cog, da_date, cog_profile)
+        pending[future] = blob_name
+
+    if pending:
+        upload_completed(ALL_COMPLETED)
+    return encode_stats
 
 
 def calculate_flood_exposure_rasterstats(
@@ -155,6 +358,12 @@ def calculate_flood_exposure_rasterstats(
     clobber: bool = False,
     verbose: bool = False,
     output_table: str = "floodscan_exposure",
+    backend: Literal["threads", "distributed"] = cluster.DASK_BACKEND,
+    cluster_kwargs: dict = None,
+    export_tabular: bool = True,
+    adm=None,
+    existing_exposure_rasters: Iterable[str] = None,
+    batch_size: int = None,
 ):
     """
     Calculate flood exposure statistics from raster data for a given country.
@@ -175,6 +384,25 @@ def calculate_flood_exposure_rasterstats(
         If True, print additional processing information. Default is False
     output_table : str, optional
         Name of the output database table. Default is "floodscan_exposure"
+    backend : Literal["threads", "distributed"], optional
+        Dask execution backend (see `cluster.dask_client`). Default is the
+        DASK_BACKEND environment variable, or "threads"
+    cluster_kwargs : dict, optional
+        Worker count, threads per worker, memory limit and spill settings
+        passed to `cluster.dask_client`
+    export_tabular : bool, optional
+        If True, also update the partitioned Parquet export of the stats
+        (see `update_exposure_tabular`). Default is True
+    adm : gpd.GeoDataFrame, optional
+        Already loaded admin 2 boundaries (loaded from blob if not provided)
+    existing_exposure_rasters : Iterable[str], optional
+        Already listed exposure COGs, as from `list_exposure_cogs` or
+        `group_exposure_cogs`
+    batch_size : int, optional
+        Maximum number of dates to process in a single batch. By default,
+        based on the size of the country's grid and the memory available
+        (see `batching.get_batch_size`), and halved if a batch runs out of
+        memory
 
     Returns
     -------
@@ -182,126 +410,186 @@ def calculate_flood_exposure_rasterstats(
         Results are written directly to the database
 
     """
-    adm = codab.load_codab_from_blob(iso3, admin_level=2)
-    existing_exposure_rasters = [
+    if adm is None:
+        adm = codab.load_codab_from_blob(iso3, admin_level=2)
+    if existing_exposure_rasters is None:
+        existing_exposure_rasters = list_exposure_cogs(iso3)
+    # in date order
+    existing_exposure_rasters = sorted(
         x
-        for x in stratus.list_container_blobs(
-            name_starts_with=f"{PROJECT_PREFIX}/processed/"
-            f"flood_exposure/{iso3}/",
-            stage=STAGE,
-        )
-        if x.endswith(".tif")
-    ]
-    existing_dates = database.get_existing_stats_dates(iso3, engine)
+        for x in existing_exposure_rasters
+        if x.startswith(f"{PROJECT_PREFIX}/processed/flood_exposure/{iso3}/")
+    )
+    existing_dates = set(database.get_existing_stats_dates(iso3, engine))
     unprocessed_exposure_rasters = [
         x
         for x in existing_exposure_rasters
-        if datetime.strptime(x.split("/")[-1][13:23], "%Y-%m-%d")
-        not in existing_dates
-        or clobber
+        if get_exposure_date(x) not in existing_dates or clobber
     ]
 
-    # break list of exposure rasters into chunks, to avoid memory issues
-    # chunk length is arbitrary, but seems to work fine
-    chunk_len = 100
-    exposure_raster_chunks = [
-        unprocessed_exposure_rasters[x : x + chunk_len]
-        for x in range(0, len(unprocessed_exposure_rasters), chunk_len)
-    ]
+    if not unprocessed_exposure_rasters:
+        print("all complete")
+        return
+
+    # break list of exposure rasters into batches, to avoid memory issues
+    if batch_size is None:
+        da_first = stratus.open_blob_cog(
+            unprocessed_exposure_rasters[0], stage=STAGE
+        )
+        batch_size = batching.get_batch_size(
+            da_first.shape[-2:], da_first.dtype
+        )
+        print(f"Using batch size {batch_size}")
 
-    # iterate over chunks
-    for exposure_raster_chunk in tqdm(exposure_raster_chunks):
-        # stack up exposure rasters in chunk
+    def process_batch(exposure_raster_batch):
+        # stack up exposure rasters in batch
         das = []
-        for blob_name in exposure_raster_chunk:
-            date_in = datetime.strptime(
-                blob_name.split("/")[-1][13:23], "%Y-%m-%d"
-            )
+        for blob_name in exposure_raster_batch:
+            date_in = get_exposure_date(blob_name)
             try:
                 da_in = stratus.open_blob_cog(blob_name, stage=STAGE)
                 da_in["date"] = date_in
-                da_in = da_in.persist()
+                da_in = cluster.chunk_to_blocks(da_in).persist()
                 das.append(da_in)
+            except batching.MEMORY_ERRORS:
+                # let the batch be retried with a smaller size
+                raise
             except Exception as e:
                 print(e)
                 print(f"couldn't open {blob_name}")
 
         if len(das) == 0:
-            print("all complete for chunk")
-            continue
+            print("all complete for batch")
+            return
         ds_exp_recent = xr.concat(das, dim="date").squeeze(
             dim="band", drop=True
         )
         if verbose:
             print(ds_exp_recent)
 
-        # iterate over admin level 2 regions and calculate exposure sums
-        dfs = []
-        for pcode, row in adm.set_index("ADM2_PCODE").iterrows():
-            da_clip = ds_exp_recent.rio.clip([row.geometry])
-            dff = (
-                da_clip.sum(dim=["x", "y"])
-                .to_dataframe(name="total_exposed")["total_exposed"]
-                .astype(int)
-                .reset_index()
-            )
-            dff["ADM2_PCODE"] = pcode
-            dfs.append(dff)
-
-        df_exp_adm_new = pd.concat(dfs, ignore_index=True)
+        df_agg = calculate_adm_stats(ds_exp_recent, adm, iso3, verbose=verbose)
         if verbose:
-            print(df_exp_adm_new)
+            print("uploading to DB:")
+            print(df_agg)
+        upload_adm_stats(df_agg, engine, output_table)
+        if export_tabular:
+            update_exposure_tabular(df_agg, iso3)
+
+    with cluster.dask_client(backend, **(cluster_kwargs or {})):
+        batching.run_in_batches(
+            unprocessed_exposure_rasters,
+            batch_size,
+            process_batch,
+            verbose=verbose,
+        )
+
+
+def calculate_adm_stats(
+    ds_exp: xr.DataArray, adm, iso3: str, verbose: bool = False
+) -> pd.DataFrame:
+    """
+    Calculate total exposure per admin, at admin levels 0, 1 and 2.
+
+    Parameters
+    ----------
+    ds_exp : xr.DataArray
+        Exposure rasters, with dimensions date, y and x
+    adm : gpd.GeoDataFrame
+        Admin 2 boundaries, as from `codab.load_codab_from_blob`
+    iso3 : str
+        Three-letter ISO country code
+    verbose : bool, optional
+        If True, print additional processing information. Default is False
 
-        # aggregate to admin levels and upload
-        df_exp_adm_new = df_exp_adm_new.merge(
-            adm[[x for x in adm.columns if "PCODE" in x]]
+    Returns
+    -------
+    pd.DataFrame
+        Exposure sums with columns valid_date, pcode, sum, adm_level and iso3
+    """
+    # iterate over admin level 2 regions and calculate exposure sums
+    dfs = []
+    for pcode, row in adm.set_index("ADM2_PCODE").iterrows():
+        # crop to the precomputed bounds first, so the geometry mask is
+        # only built for the area around the admin (small admins can crop to
+        # a single row or column of pixels)
+        da_clip = ds_exp.rio.clip_box(
+            row.minx,
+            row.miny,
+            row.maxx,
+            row.maxy,
+            allow_one_dimensional_raster=True,
+        ).rio.clip([row.geometry])
+        dff = (
+            da_clip.sum(dim=["x", "y"])
+            .to_dataframe(name="total_exposed")["total_exposed"]
+            .astype(int)
+            .reset_index()
         )
+        dff["ADM2_PCODE"] = pcode
+        dfs.append(dff)
+
+    df_exp_adm_new = pd.concat(dfs, ignore_index=True)
+    if verbose:
+        print(df_exp_adm_new)
+
+    # aggregate to admin levels
+    df_exp_adm_new = df_exp_adm_new.merge(
+        adm[[x for x in adm.columns if "PCODE" in x]]
+    )
+    if verbose:
+        print("new raster stats calculated:")
+        print(df_exp_adm_new)
+
+    df_aggs = []
+    for adm_level in [0, 1, 2]:
         if verbose:
-            print("new raster stats calculated:")
-            print(df_exp_adm_new)
+            print("aggregating to adm level:")
+            print(adm_level)
+        pcode_col = f"ADM{adm_level}_PCODE"
+        df_agg = (
+            df_exp_adm_new.groupby(["date", pcode_col])["total_exposed"]
+            .sum()
+            .reset_index()
+        )
+        df_agg["adm_level"] = adm_level
+        df_agg["iso3"] = iso3.upper()
+        df_agg = df_agg.rename(
+            columns={
+                "total_exposed": "sum",
+                pcode_col: "pcode",
+                "date": "valid_date",
+            }
+        )
+        df_aggs.append(df_agg)
+    return pd.concat(df_aggs, ignore_index=True)
 
-        for adm_level in [0, 1, 2]:
-            if verbose:
-                print("aggregating to adm level:")
-                print(adm_level)
-            pcode_col = f"ADM{adm_level}_PCODE"
-            df_agg = (
-                df_exp_adm_new.groupby(["date", pcode_col])["total_exposed"]
-                .sum()
-                .reset_index()
-            )
-            df_agg["adm_level"] = adm_level
-            df_agg["iso3"] = iso3.upper()
-            df_agg = df_agg.rename(
-                columns={
-                    "total_exposed": "sum",
-                    pcode_col: "pcode",
-                    "date": "valid_date",
-                }
-            )
-            if verbose:
-                print("uploading to DB:")
-                print(df_agg)
-            df_agg.to_sql(
-                output_table,
-                schema="app",
-                con=engine,
-                if_exists="append",
-                chunksize=10000,
-                index=False,
-                method=stratus.postgres_upsert,
-            )
+
+def upload_adm_stats(
+    df: pd.DataFrame,
+    engine: Engine,
+    output_table: str = "floodscan_exposure",
+):
+    """Upsert admin exposure stats to the database"""
+    df.to_sql(
+        output_table,
+        schema="app",
+        con=engine,
+        if_exists="append",
+        chunksize=10000,
+        index=False,
+        method=stratus.postgres_upsert,
+    )
 
 
 def calculate_flood_exposure_rasterstats_regions(
     region: dict,
     engine: Engine,
     output_table: str = "floodscan_exposure_regions",
+    dates: list = None,
 ):
     print(f"Processing {region['iso3']} region {region['region_number']}")
-    adm_stats_df = database.get_existing_adm_stats(region["pcodes"], engine)
-    region_stats_df = (
-        adm_stats_df.groupby("valid_date")["sum"].sum().reset_index()
+    region_stats_df = database.get_summed_adm_stats(
+        region["pcodes"], engine, dates=dates
     )
     region_stats_df["iso3"] = region["iso3"].upper()
     region_stats_df["pcode"] = (
@@ -320,10 +608,164 @@ def calculate_flood_exposure_rasterstats_regions(
     )
 
 
+def update_exposure_tabular(df: pd.DataFrame, iso3: str):
+    """
+    Update the Parquet export of admin exposure stats, partitioned by country
+    and year.
+
+    New rows replace any existing rows for the same pcode and date. Rows are
+    sorted by adm_level, pcode and date, and written in small row groups, so
+    that reads filtering on these columns can skip most of each file.
+
+    Each partition is only replaced if no other run has written it since it
+    was read, and is otherwise read and merged again, so concurrent runs
+    don't drop each other's rows.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Exposure stats, as from `calculate_adm_stats`
+    iso3 : str
+        ISO3 code of the country
+
+    Returns
+    -------
+    None
+    """
+    iso3 = iso3.lower()
+    df = df[TABULAR_COLS].copy()
+    df["valid_date"] = pd.to_datetime(df["valid_date"])
+    df["adm_level"] = df["adm_level"].astype(str)
+    for year, df_year in df.groupby(df["valid_date"].dt.year):
+        blob_name = get_blob_name(iso3, "exposure_tabular", year=year)
+        # other runs may write the same partition, so only replace it if it
+        # hasn't changed since it was read, and otherwise merge again
+        for _ in range(TABULAR_WRITE_ATTEMPTS):
+            data, etag = blob.load_blob_data_with_etag(blob_name, stage=STAGE)
+            df_merged = df_year
+            if data is not None:
+                df_merged = pd.concat(
+                    [pd.read_parquet(BytesIO(data)), df_year],
+                    ignore_index=True,
+                )
+            df_merged = df_merged.drop_duplicates(
+                subset=["pcode", "valid_date"], keep="last"
+            ).sort_values(["adm_level", "pcode", "valid_date"])
+            buffer = BytesIO()
+            df_merged.to_parquet(
+                buffer, index=False, row_group_size=TABULAR_ROW_GROUP_SIZE
+            )
+            if blob.upload_blob_data_if_unchanged(
+                blob_name, buffer.getvalue(), etag, stage=STAGE
+            ):
+                break
+            print(f"{blob_name} was updated by another run, merging again")
+        else:
+            raise RuntimeError(
+                f"couldn't update {blob_name} after "
+                f"{TABULAR_WRITE_ATTEMPTS} attempts"
+            )
+
+
+def backfill_exposure_tabular(iso3: str, engine: Engine):
+    """Write the Parquet export of a country's stats from the database"""
+    print(f"exporting {iso3} stats from database")
+    # stream in date order, so each partition is only rewritten a few times
+    for df in database.iter_adm_stats(engine, iso3=iso3, chunksize=500000):
+        update_exposure_tabular(df, iso3)
+
+
+@lru_cache(maxsize=64)
+def _load_tabular_partition(blob_name: str, etag: str) -> bytes:
+    # keyed on the etag too, so a partition rewritten since it was cached
+    # (by this or any other process) is read again
+    return blob.load_blob_data(blob_name, stage=STAGE)
+
+
+def load_exposure_tabular(
+    iso3: str,
+    pcodes: List[str] = None,
+    adm_level: int = None,
+    start_date: str = None,
+    end_date: str = None,
+) -> pd.DataFrame:
+    """
+    Load admin exposure stats from the partitioned Parquet export.
+
+    Only the yearly partitions overlapping the date range are read, and
+    filters are pushed down to the Parquet reader. Recently read partitions
+    are cached in memory, until they are next updated in blob storage.
+
+    Parameters
+    ----------
+    iso3 : str
+        ISO3 code of the country
+    pcodes : List[str], optional
+        Only load these pcodes
+    adm_level : int, optional
+        Only load this admin level
+    start_date : str, optional
+        First date to load, in "YYYY-MM-DD" format
+    end_date : str, optional
+        Last date to load, in "YYYY-MM-DD" format
+
+    Returns
+    -------
+    pd.DataFrame
+        Exposure stats with columns iso3, adm_level, pcode, valid_date and sum
+    """
+    iso3 = iso3.lower()
+    # list with properties, to get the current etag of each partition
+    container_client = stratus.get_container_client(
+        stage=STAGE, container_name="projects"
+    )
+    etags = {
+        x.name: x.etag
+        for x in container_client.list_blobs(
+            name_starts_with=get_tabular_partition_prefix(iso3)
+        )
+    }
+    filters = []
+    if pcodes is not None:
+        filters.append(("pcode", "in", list(pcodes)))
+    if adm_level is not None:
+        filters.append(("adm_level", "==", str(adm_level)))
+    if start_date is not None:
+        filters.append(("valid_date", ">=", pd.Timestamp(start_date)))
+    if end_date is not None:
+        filters.append(("valid_date", "<=", pd.Timestamp(end_date)))
+
+    dfs = []
+    for blob_name in sorted(etags):
+        year = int(blob_name.removesuffix(".parquet")[-4:])
+        if start_date is not None and year < pd.Timestamp(start_date).year:
+            continue
+        if end_date is not None and year > pd.Timestamp(end_date).year:
+            continue
+        dfs.append(
+            pd.read_parquet(
+                BytesIO(_load_tabular_partition(blob_name, etags[blob_name])),
+                filters=filters or None,
+            )
+        )
+    if not dfs:
+        return pd.DataFrame(columns=TABULAR_COLS)
+    return pd.concat(dfs, ignore_index=True)
+
+
+def get_tabular_partition_prefix(iso3: str):
+    """Get the blob prefix of the yearly partitions of exposure_tabular"""
+    return (
+        f"{PROJECT_PREFIX}/processed/flood_exposure/tabular/"
+        f"{iso3}_adm_flood_exposure/"
+    )
+
+
 def get_blob_name(
     iso3: str,
     data_type: Literal["exposure_raster", "exposure_tabular"],
     date: str = None,
+    year: int = None,
 ):
     """
     Get the blob name for a given data type and date.
@@ -337,6 +779,9 @@ def get_blob_name(
     date: str
         Date of the exposure raster, in "YYYY-MM-DD" format
         Not relevant for exposure_tabular
+    year: int
+        Year of the partition of exposure_tabular. If not provided, the name
+        of the (unpartitioned) single file is returned
 
     Returns
     -------
@@ -351,6 +796,11 @@ def get_blob_name(
             f"{iso3}/{iso3}_exposure_{date}.tif"
         )
     elif data_type == "exposure_tabular":
+        if year is not None:
+            return (
+                f"{get_tabular_partition_prefix(iso3)}"
+                f"{iso3}_adm_flood_exposure_{year}.parquet"
+            )
         return (
             f"{PROJECT_PREFIX}/processed/flood_exposure/tabular/"
             f"{iso3}_adm_flood_exposure.parquet"
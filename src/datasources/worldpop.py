@@ -6,8 +6,12 @@ import requests
 import rioxarray as rxr
 
 from src.constants import PROJECT_PREFIX, STAGE, WORLDPOP_BASE_URL
+from src.datasources import codab
 from src.utils import blob
 
+# resolution of the 1km WorldPop grid, in degrees (30 arc-seconds)
+WORLDPOP_RESOLUTION = 1 / 120
+
 
 def get_blob_name(iso3: str):
     iso3 = iso3.lower()
@@ -39,3 +43,17 @@ def load_worldpop_from_blob(iso3: str):
     da = da.where(da != da.attrs["_FillValue"]).squeeze(drop=True)
     da.attrs["_FillValue"] = np.nan
     return da
+
+
+def estimate_grid_size(iso3: str) -> int:
+    """
+    Estimate the number of cells in a country's WorldPop grid from its
+    boundary, without downloading the grid.
+    """
+    minx, miny, maxx, maxy = codab.load_codab_from_blob(
+        iso3, admin_level=0
+    ).total_bounds
+    return int(
+        ((maxx - minx) / WORLDPOP_RESOLUTION)
+        * ((maxy - miny) / WORLDPOP_RESOLUTION)
+    )
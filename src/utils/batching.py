@@ -0,0 +1,142 @@
+import gc
+import os
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Sequence
+
+import numpy as np
+from dask.utils import parse_bytes
+from tqdm.auto import tqdm
+
+# memory available to the pipeline (e.g. "8GiB"). Detected if not set.
+MEMORY_LIMIT = os.getenv("MEMORY_LIMIT")
+
+# rough number of full-size copies of each date held in memory at once
+# (e.g. raw, filtered, regridded and exposure rasters)
+COPIES_PER_DATE = 4
+
+# errors raised when a batch runs out of memory, including when a dask
+# worker or encoding process is killed for using too much
+try:
+    from distributed import KilledWorker
+
+    MEMORY_ERRORS = (MemoryError, BrokenProcessPool, KilledWorker)
+except ImportError:
+    MEMORY_ERRORS = (MemoryError, BrokenProcessPool)
+
+
+def get_memory_limit() -> int:
+    """
+    Get the memory available, in bytes.
+
+    Uses MEMORY_LIMIT if set, otherwise the smaller of the physical memory
+    and any cgroup (container) limit.
+    """
+    if MEMORY_LIMIT:
+        return parse_bytes(MEMORY_LIMIT)
+    limit = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    for path in [
+        "/sys/fs/cgroup/memory.max",
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+    ]:
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit():
+            limit = min(limit, int(value))
+    return limit
+
+
+def get_batch_size(
+    shape: Sequence[int],
+    dtype,
+    memory_limit: int = None,
+    memory_fraction: float = 0.5,
+    max_batch_size: int = 365,
+) -> int:
+    """
+    Get the number of dates to process in one batch, so that a batch fits in
+    a fraction of the available memory.
+
+    Parameters
+    ----------
+    shape : Sequence[int]
+        Shape of a single date's raster (e.g. the WorldPop grid)
+    dtype
+        Data type of the raster
+    memory_limit : int, optional
+        Memory available in bytes. Detected if not provided
+    memory_fraction : float, optional
+        Fraction of the memory to use for a batch
+    max_batch_size : int, optional
+        Upper limit on the batch size
+
+    Returns
+    -------
+    int
+        Batch size, between 1 and `max_batch_size`
+    """
+    if memory_limit is None:
+        memory_limit = get_memory_limit()
+    date_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    batch_size = int(
+        memory_limit * memory_fraction // (date_bytes * COPIES_PER_DATE)
+    )
+    return max(1, min(batch_size, max_batch_size))
+
+
+def run_in_batches(
+    items: list,
+    batch_size: int,
+    func: Callable,
+    verbose: bool = False,
+    on_memory_error: Callable = None,
+) -> list:
+    """
+    Call `func` on successive batches of `items`, halving the batch size and
+    retrying the batch if it runs out of memory.
+
+    Parameters
+    ----------
+    items : list
+        Items to process
+    batch_size : int
+        Initial batch size
+    func : Callable
+        Function taking a list of items
+    verbose : bool, optional
+        Whether to print each batch
+    on_memory_error : Callable, optional
+        Called with no arguments before retrying a batch, e.g. to restart a
+        process pool broken by a killed process
+
+    Returns
+    -------
+    list
+        Results of `func` for each batch
+    """
+    results = []
+    start = 0
+    with tqdm(total=len(items)) as pbar:
+        while start < len(items):
+            batch = items[start : start + batch_size]
+            if verbose:
+                print(
+                    f"Processing items {start + 1}-{start + len(batch)} "
+                    f"of {len(items)}"
+                )
+            try:
+                results.append(func(batch))
+            except MEMORY_ERRORS:
+                if batch_size == 1:
+                    raise
+                batch_size = max(1, batch_size // 2)
+                print(f"out of memory, retrying with batch size {batch_size}")
+                if on_memory_error is not None:
+                    on_memory_error()
+                gc.collect()
+                continue
+            start += len(batch)
+            pbar.update(len(batch))
+    return results
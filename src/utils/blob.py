@@ -1,6 +1,12 @@
 from typing import Literal
 
 import ocha_stratus as stratus
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    ResourceExistsError,
+    ResourceModifiedError,
+    ResourceNotFoundError,
+)
 from azure.storage.blob import ContentSettings
 
 
@@ -17,6 +23,27 @@ def load_blob_data(
     return data
 
 
+def load_blob_data_with_etag(
+    blob_name,
+    stage: Literal["prod", "dev"] = "dev",
+    container_name: str = "projects",
+):
+    """
+    Load blob data along with the etag of the version read, for a later
+    `upload_blob_data_if_unchanged`. Returns (None, None) if the blob
+    doesn't exist.
+    """
+    container_client = stratus.get_container_client(
+        stage=stage, container_name=container_name
+    )
+    blob_client = container_client.get_blob_client(blob_name)
+    try:
+        downloader = blob_client.download_blob()
+    except ResourceNotFoundError:
+        return None, None
+    return downloader.readall(), downloader.properties.etag
+
+
 def upload_blob_data(
     blob_name,
     data,
@@ -39,3 +66,41 @@ def upload_blob_data(
     blob_client.upload_blob(
         data, overwrite=True, content_settings=content_settings
     )
+
+
+def upload_blob_data_if_unchanged(
+    blob_name,
+    data,
+    etag,
+    stage: Literal["prod", "dev"] = "dev",
+    container_name: str = "projects",
+    content_type: str = None,
+) -> bool:
+    """
+    Upload blob data only if the blob is still at the version with `etag`,
+    or still doesn't exist if `etag` is None. Returns False, without
+    uploading, if the blob has been written since.
+    """
+    container_client = stratus.get_container_client(
+        stage=stage, container_name=container_name, write=True
+    )
+    content_settings = ContentSettings(
+        content_type=content_type or "application/octet-stream"
+    )
+    blob_client = container_client.get_blob_client(blob_name)
+    try:
+        if etag is None:
+            blob_client.upload_blob(
+                data, overwrite=False, content_settings=content_settings
+            )
+        else:
+            blob_client.upload_blob(
+                data,
+                overwrite=True,
+                content_settings=content_settings,
+                etag=etag,
+                match_condition=MatchConditions.IfNotModified,
+            )
+    except (ResourceExistsError, ResourceModifiedError):
+        return False
+    return True
@@ -0,0 +1,134 @@
+import os
+from contextlib import contextmanager
+from typing import Literal
+
+import dask
+import xarray as xr
+
+# execution backend for dask computations: "threads" uses dask's default
+# local threaded scheduler, "distributed" starts a local distributed cluster
+DASK_BACKEND = os.getenv("DASK_BACKEND", "threads")
+DASK_N_WORKERS = os.getenv("DASK_N_WORKERS")
+DASK_THREADS_PER_WORKER = os.getenv("DASK_THREADS_PER_WORKER")
+DASK_MEMORY_LIMIT = os.getenv("DASK_MEMORY_LIMIT", "auto")
+DASK_SPILL_DIR = os.getenv("DASK_SPILL_DIR")
+
+# default block size of COGs written by rioxarray / GDAL
+COG_BLOCK_SIZE = 512
+
+
+@contextmanager
+def dask_client(
+    backend: Literal["threads", "distributed"] = DASK_BACKEND,
+    n_workers: int = DASK_N_WORKERS,
+    threads_per_worker: int = DASK_THREADS_PER_WORKER,
+    memory_limit: str = DASK_MEMORY_LIMIT,
+    spill_dir: str = DASK_SPILL_DIR,
+    memory_target: float = 0.6,
+    memory_spill: float = 0.7,
+    memory_pause: float = 0.8,
+):
+    """
+    Context manager for running dask computations on a given backend.
+
+    If a distributed client is already running (e.g. one shared between
+    pipeline stages), it is reused rather than starting another cluster.
+
+    Parameters
+    ----------
+    backend : Literal["threads", "distributed"]
+        "threads" to use dask's default threaded scheduler, "distributed" to
+        start a local distributed cluster for the duration of the context
+    n_workers : int, optional
+        Number of worker processes. Defaults to dask's choice based on the
+        number of cores
+    threads_per_worker : int, optional
+        Number of threads per worker
+    memory_limit : str, optional
+        Memory limit per worker (e.g. "4GiB"), or "auto" to split the
+        system memory between workers
+    spill_dir : str, optional
+        Directory for workers to spill data to disk. Defaults to a temporary
+        directory
+    memory_target : float, optional
+        Fraction of the memory limit at which workers start spilling to disk
+    memory_spill : float, optional
+        Fraction of the memory limit (based on process memory) at which
+        workers spill to disk
+    memory_pause : float, optional
+        Fraction of the memory limit at which workers stop accepting new tasks
+
+    Yields
+    ------
+    distributed.Client or None
+        Client connected to the cluster, or None for the threaded backend
+    """
+    if backend == "threads":
+        yield None
+        return
+    elif backend != "distributed":
+        raise ValueError(f"unrecognized dask backend: {backend}")
+
+    # only needed for the distributed backend
+    from dask.distributed import Client, LocalCluster
+
+    try:
+        client = Client.current()
+    except ValueError:
+        client = None
+    if client is not None:
+        yield client
+        return
+
+    with dask.config.set(
+        {
+            "distributed.worker.memory.target": memory_target,
+            "distributed.worker.memory.spill": memory_spill,
+            "distributed.worker.memory.pause": memory_pause,
+        }
+    ):
+        with LocalCluster(
+            n_workers=int(n_workers) if n_workers else None,
+            threads_per_worker=(
+                int(threads_per_worker) if threads_per_worker else None
+            ),
+            memory_limit=memory_limit,
+            local_directory=spill_dir,
+        ) as cluster, Client(cluster) as client:
+            print(f"dask dashboard at {client.dashboard_link}")
+            yield client
+
+
+def chunk_to_blocks(
+    da: xr.DataArray, blocks_per_chunk: int = 4, x_dim="x", y_dim="y"
+) -> xr.DataArray:
+    """
+    Rechunk a DataArray so that spatial chunks are whole multiples of the
+    COG block size.
+
+    The block size is taken from the source COG (via rioxarray's
+    `preferred_chunks` encoding) if available, or the default COG block size
+    otherwise. All other dimensions (e.g. date) have a chunk size of 1, so
+    that selecting a single date only computes that date.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        DataArray to rechunk
+    blocks_per_chunk : int, optional
+        Number of blocks along each spatial dimension in a single chunk
+    x_dim : str, optional
+        Name of the x dimension
+    y_dim : str, optional
+        Name of the y dimension
+
+    Returns
+    -------
+    xr.DataArray
+        Rechunked DataArray
+    """
+    preferred = da.encoding.get("preferred_chunks", {})
+    chunks = {dim: 1 for dim in da.dims}
+    for dim in [x_dim, y_dim]:
+        chunks[dim] = preferred.get(dim, COG_BLOCK_SIZE) * blocks_per_chunk
+    return da.chunk(chunks)
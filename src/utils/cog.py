@@ -0,0 +1,177 @@
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import pandas as pd
+import rioxarray  # noqa: F401
+import xarray as xr
+
+# GDAL COG creation options for each encoding profile. "default" is GDAL's
+# own COG defaults, as previously used via `stratus.upload_cog_to_blob`.
+COG_PROFILES = {
+    "default": {"compress": "LZW", "blocksize": 512, "overviews": "AUTO"},
+    "deflate": {
+        "compress": "DEFLATE",
+        "predictor": 3,
+        "level": 6,
+        "blocksize": 512,
+        "overviews": "AUTO",
+    },
+    "zstd": {
+        "compress": "ZSTD",
+        "predictor": 3,
+        "level": 9,
+        "blocksize": 512,
+        "overviews": "AUTO",
+    },
+    "zstd_fast": {
+        "compress": "ZSTD",
+        "predictor": 3,
+        "level": 1,
+        "blocksize": 1024,
+        "overviews": "NONE",
+    },
+}
+
+
+class EncodeExecutor:
+    """
+    Process pool for encoding COGs, which can be restarted in place if it
+    breaks (e.g. a process is killed for running out of memory), so that
+    code sharing it keeps working.
+    """
+
+    def __init__(self, max_workers: int = None):
+        self.max_workers = max_workers
+        self._start()
+
+    def _start(self):
+        # processes are spawned rather than forked, so that they don't
+        # inherit the state of any running dask threads
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.max_workers, mp_context=get_context("spawn")
+        )
+
+    def submit(self, fn, *args, **kwargs):
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def restart(self):
+        """Replace the pool with a new one, cancelling any pending work"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._start()
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+
+def get_encode_executor(max_workers: int = None) -> EncodeExecutor:
+    """
+    Get a process pool for encoding COGs.
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        Number of processes. Defaults to the number of cores
+
+    Returns
+    -------
+    EncodeExecutor
+    """
+    return EncodeExecutor(max_workers=max_workers)
+
+
+def encode_cog(da: xr.DataArray, profile: str = "default"):
+    """
+    Encode a DataArray as a COG.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        Loaded (not lazy) 2D DataArray with a CRS set
+    profile : str, optional
+        Name of encoding profile in COG_PROFILES
+
+    Returns
+    -------
+    tuple[bytes, float]
+        Encoded COG, and time taken to encode it in seconds
+    """
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "cog.tif")
+        da.rio.to_raster(path, driver="COG", **COG_PROFILES[profile])
+        with open(path, "rb") as f:
+            data = f.read()
+    return data, time.perf_counter() - start
+
+
+def summarize_encode_stats(stats: list) -> pd.DataFrame:
+    """
+    Summarize encode times and output sizes per profile.
+
+    Parameters
+    ----------
+    stats : list
+        List of dicts with keys profile, encode_time and size
+
+    Returns
+    -------
+    pd.DataFrame
+        Count, total and mean encode time, and total and mean size in MB,
+        per profile
+    """
+    df = pd.DataFrame(stats, columns=["profile", "encode_time", "size"])
+    df["size_mb"] = df["size"] / 1e6
+    return df.groupby("profile").agg(
+        n=("size", "count"),
+        encode_time_total=("encode_time", "sum"),
+        encode_time_mean=("encode_time", "mean"),
+        size_mb_total=("size_mb", "sum"),
+        size_mb_mean=("size_mb", "mean"),
+    )
+
+
+def compare_profiles(
+    da: xr.DataArray, profiles: list = None, executor=None
+) -> pd.DataFrame:
+    """
+    Encode a sample DataArray with several profiles, to compare output size
+    and encode time.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        2D DataArray with a CRS set
+    profiles : list, optional
+        Names of profiles to compare. Defaults to all of COG_PROFILES
+    executor : EncodeExecutor, optional
+        Pool to encode in. If not provided, profiles are encoded one after
+        the other in this process
+
+    Returns
+    -------
+    pd.DataFrame
+        Encode stats per profile, as from `summarize_encode_stats`
+    """
+    profiles = profiles or list(COG_PROFILES)
+    da = da.load()
+    if executor is None:
+        results = [encode_cog(da, profile) for profile in profiles]
+    else:
+        futures = [
+            executor.submit(encode_cog, da, profile) for profile in profiles
+        ]
+        results = [future.result() for future in futures]
+    stats = [
+        {"profile": profile, "encode_time": encode_time, "size": len(data)}
+        for profile, (data, encode_time) in zip(profiles, results)
+    ]
+    return summarize_encode_stats(stats)
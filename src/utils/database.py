@@ -1,5 +1,7 @@
-from typing import List
+from functools import lru_cache
+from typing import Iterator, List
 
+import ocha_stratus as stratus
 import pandas as pd
 from sqlalchemy import (
     CHAR,
@@ -11,7 +13,14 @@ from sqlalchemy import (
     String,
     Table,
     UniqueConstraint,
+    inspect,
+    text,
 )
+from sqlalchemy.engine import Engine
+
+from src.constants import STAGE
+
+STATS_COLS = ["iso3", "adm_level", "valid_date", "pcode", "sum"]
 
 
 def create_flood_exposure_table(dataset, engine):
@@ -57,7 +66,48 @@ def create_flood_exposure_table(dataset, engine):
     return
 
 
-def get_existing_stats_dates(iso3: str, engine) -> list:
+@lru_cache
+def get_engine(stage: str = STAGE, write: bool = True) -> Engine:
+    """
+    Get a database engine for a stage, shared by everything in the process
+    so that connections are pooled rather than opened per caller.
+    """
+    return stratus.get_engine(stage=stage, write=write)
+
+
+def _date_filter(start_date=None, end_date=None, dates: List = None):
+    # build a bound-parameter date filter clause
+    clauses, params = [], {}
+    if start_date is not None:
+        clauses.append("AND valid_date >= :start_date")
+        params["start_date"] = pd.Timestamp(start_date).date()
+    if end_date is not None:
+        clauses.append("AND valid_date <= :end_date")
+        params["end_date"] = pd.Timestamp(end_date).date()
+    if dates is not None:
+        clauses.append("AND valid_date = ANY(:dates)")
+        params["dates"] = [pd.Timestamp(x).date() for x in dates]
+    return "\n".join(clauses), params
+
+
+def read_sql_chunks(
+    query, engine, params: dict = None, chunksize: int = 100000
+) -> Iterator[pd.DataFrame]:
+    """
+    Stream the results of a query in chunks, using a server-side cursor so
+    that the full result is never held in memory at once.
+    """
+    with engine.connect().execution_options(
+        stream_results=True, max_row_buffer=chunksize
+    ) as con:
+        yield from pd.read_sql(
+            query, con=con, params=params, chunksize=chunksize
+        )
+
+
+def get_existing_stats_dates(
+    iso3: str, engine, start_date=None, end_date=None
+) -> list:
     """
     Retrieve list of dates for which flood statistics exist
     for a given country.
@@ -68,26 +118,97 @@ def get_existing_stats_dates(iso3: str, engine) -> list:
         Three-letter ISO country code
     engine : Engine
         SQLAlchemy database engine
+    start_date : optional
+        If provided, only look for dates from this date
+    end_date : optional
+        If provided, only look for dates up to this date
 
     Returns
     -------
     list
         Dates with existing flood statistics
     """
-    query = f"""
-    SELECT DISTINCT valid_date
-    FROM app.floodscan_exposure
-    WHERE iso3 = '{iso3.upper()}'
-    ORDER BY valid_date
-    """
-    df_unique_dates = pd.read_sql(query, con=engine)
+    date_filter, params = _date_filter(start_date, end_date)
+    query = text(
+        f"""
+        SELECT DISTINCT valid_date
+        FROM app.floodscan_exposure
+        WHERE iso3 = :iso3
+        {date_filter}
+        ORDER BY valid_date
+        """
+    )
+    df_unique_dates = pd.read_sql(
+        query, con=engine, params={"iso3": iso3.upper(), **params}
+    )
     df_unique_dates["valid_date"] = pd.to_datetime(
         df_unique_dates["valid_date"]
     )
     return df_unique_dates["valid_date"].to_list()
 
 
-def get_existing_adm_stats(pcodes: List[str], engine) -> pd.DataFrame:
+def iter_adm_stats(
+    engine,
+    pcodes: List[str] = None,
+    iso3: str = None,
+    start_date=None,
+    end_date=None,
+    dates: List = None,
+    columns: List[str] = STATS_COLS,
+    chunksize: int = 100000,
+) -> Iterator[pd.DataFrame]:
+    """
+    Stream flood exposure statistics, filtered in the database.
+
+    Parameters
+    ----------
+    engine : Engine
+        SQLAlchemy database engine
+    pcodes : List[str], optional
+        Only fetch these pcodes
+    iso3 : str, optional
+        Only fetch this country
+    start_date : optional
+        Only fetch dates from this date
+    end_date : optional
+        Only fetch dates up to this date
+    dates : List, optional
+        Only fetch these dates
+    columns : List[str], optional
+        Columns to fetch, from STATS_COLS
+    chunksize : int, optional
+        Number of rows in each chunk
+
+    Yields
+    ------
+    pd.DataFrame
+        Chunks of flood exposure statistics, ordered by date
+    """
+    if not set(columns) <= set(STATS_COLS):
+        raise ValueError(f"columns must be in {STATS_COLS}")
+    date_filter, params = _date_filter(start_date, end_date, dates)
+    filters = [date_filter]
+    if pcodes is not None:
+        filters.append("AND pcode = ANY(:pcodes)")
+        params["pcodes"] = list(pcodes)
+    if iso3 is not None:
+        filters.append("AND iso3 = :iso3")
+        params["iso3"] = iso3.upper()
+    query = text(
+        f"""
+        SELECT {", ".join(columns)}
+        FROM app.floodscan_exposure
+        WHERE TRUE
+        {" ".join(filters)}
+        ORDER BY valid_date
+        """
+    )
+    yield from read_sql_chunks(query, engine, params, chunksize)
+
+
+def get_existing_adm_stats(
+    pcodes: List[str], engine, dates: List = None
+) -> pd.DataFrame:
     """
     Fetch flood exposure statistics for specified administrative regions.
 
@@ -97,15 +218,210 @@ def get_existing_adm_stats(pcodes: List[str], engine) -> pd.DataFrame:
         List of administrative region codes
     engine : Engine
         SQLAlchemy database engine
+    dates : List, optional
+        If provided, only fetch statistics for these dates
 
     Returns
     -------
     pd.DataFrame
         Flood exposure statistics for requested regions
     """
-    query = f"""
-    SELECT *
-    FROM app.floodscan_exposure
-    WHERE pcode IN ({", ".join([f"'{pcode}'" for pcode in pcodes])})
+    chunks = list(iter_adm_stats(engine, pcodes=pcodes, dates=dates))
+    if not chunks:
+        return pd.DataFrame(columns=STATS_COLS)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def get_summed_adm_stats(
+    pcodes: List[str], engine, dates: List = None
+) -> pd.DataFrame:
     """
-    return pd.read_sql(query, con=engine)
+    Fetch the total flood exposure over several administrative regions,
+    summed in the database.
+
+    Parameters
+    ----------
+    pcodes : List[str]
+        List of administrative region codes
+    engine : Engine
+        SQLAlchemy database engine
+    dates : List, optional
+        If provided, only fetch statistics for these dates
+
+    Returns
+    -------
+    pd.DataFrame
+        Total exposure with columns valid_date and sum
+    """
+    date_filter, params = _date_filter(dates=dates)
+    query = text(
+        f"""
+        SELECT valid_date, SUM(sum) AS sum
+        FROM app.floodscan_exposure
+        WHERE pcode = ANY(:pcodes)
+        {date_filter}
+        GROUP BY valid_date
+        ORDER BY valid_date
+        """
+    )
+    return pd.read_sql(
+        query, con=engine, params={"pcodes": list(pcodes), **params}
+    )
+
+
+def get_rolling_window_inputs(
+    table_name: str, month: int, day: int, max_window: int, con
+) -> pd.DataFrame:
+    """
+    Fetch the daily values needed to calculate trailing rolling averages
+    ending on a given month and day of every year.
+
+    Only rows falling within `max_window` days before (and including) one of
+    the target dates are returned, ordered by pcode and date, so that each
+    series only needs to be read once regardless of how many windows are
+    calculated from it.
+
+    Parameters
+    ----------
+    table_name : str
+        Name of the exposure table in the `app` schema
+    month : int
+        Month of the target dates
+    day : int
+        Day of month of the target dates
+    max_window : int
+        Longest rolling window to be calculated, in days
+    con : Engine or Connection
+        SQLAlchemy database engine or connection
+
+    Returns
+    -------
+    pd.DataFrame
+        Daily values with columns pcode, adm_level, valid_date and sum
+    """
+    query = text(
+        f"""
+        WITH target_dates AS (
+            SELECT DISTINCT valid_date AS target_date
+            FROM app.{table_name}
+            WHERE EXTRACT(MONTH FROM valid_date) = :month
+                AND EXTRACT(DAY FROM valid_date) = :day
+        )
+        SELECT pcode, adm_level, valid_date, sum
+        FROM app.{table_name} d
+        WHERE EXISTS (
+            SELECT 1
+            FROM target_dates t
+            WHERE d.valid_date BETWEEN t.target_date - :offset
+                AND t.target_date
+        )
+        ORDER BY pcode, adm_level, valid_date
+        """
+    )
+    return pd.read_sql_query(
+        query,
+        con,
+        params={"month": month, "day": day, "offset": max_window - 1},
+    )
+
+
+def _admin_lookup_key(df: pd.DataFrame) -> pd.Series:
+    # rows are refreshed per country (adm0 pcode) or per region
+    key = df["adm0_pcode"]
+    if "admregion_pcode" in df.columns:
+        key = key.fillna(df["admregion_pcode"])
+    return key
+
+
+def update_admin_lookup(df: pd.DataFrame, engine, table_name="admin_lookup"):
+    """
+    Refresh the admin lookup table, only rewriting countries or regions whose
+    rows have changed.
+
+    Changed rows are deleted and re-inserted in a single transaction, so the
+    table stays readable throughout. If the columns have changed, a new table
+    is written and swapped in for the old one, also in a single transaction.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Full admin lookup table, as built by `codab.load_geo_data`
+    engine : Engine
+        SQLAlchemy database engine
+    table_name : str, optional
+        Name of the table in the `app` schema
+
+    Returns
+    -------
+    None
+    """
+    inspector = inspect(engine)
+    if not inspector.has_table(table_name, schema="app"):
+        print(f"creating {table_name}")
+        df.to_sql(table_name, schema="app", con=engine, index=False)
+        return
+
+    existing_cols = [
+        x["name"] for x in inspector.get_columns(table_name, schema="app")
+    ]
+    if set(existing_cols) != set(df.columns):
+        print(f"{table_name} columns have changed, swapping in new table")
+        df.to_sql(
+            f"{table_name}_new",
+            schema="app",
+            con=engine,
+            if_exists="replace",
+            index=False,
+        )
+        with engine.begin() as con:
+            con.execute(text(f"DROP TABLE app.{table_name}"))
+            con.execute(
+                text(
+                    f"ALTER TABLE app.{table_name}_new "
+                    f"RENAME TO {table_name}"
+                )
+            )
+        return
+
+    df_existing = pd.read_sql_table(table_name, con=engine, schema="app")
+    cols = sorted(df.columns)
+    key_new = _admin_lookup_key(df)
+    key_existing = _admin_lookup_key(df_existing)
+
+    changed = []
+    for key in set(key_new.dropna()) | set(key_existing.dropna()):
+        rows_new = set(
+            df.loc[key_new == key, cols]
+            .fillna("")
+            .astype(str)
+            .itertuples(index=False, name=None)
+        )
+        rows_existing = set(
+            df_existing.loc[key_existing == key, cols]
+            .fillna("")
+            .astype(str)
+            .itertuples(index=False, name=None)
+        )
+        if rows_new != rows_existing:
+            changed.append(key)
+
+    if not changed:
+        print(f"{table_name} is up to date")
+        return
+
+    print(f"updating {table_name} for: {', '.join(sorted(changed))}")
+    key_sql = "adm0_pcode"
+    if "admregion_pcode" in df.columns:
+        key_sql = "COALESCE(adm0_pcode, admregion_pcode)"
+    with engine.begin() as con:
+        con.execute(
+            text(f"DELETE FROM app.{table_name} WHERE {key_sql} = ANY(:keys)"),
+            {"keys": changed},
+        )
+        df[key_new.isin(changed)].to_sql(
+            table_name,
+            schema="app",
+            con=con,
+            if_exists="append",
+            index=False,
+        )
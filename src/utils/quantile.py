@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from src.constants import ROLL_WINDOWS
+from src.utils import database, rolling
+
+
+def assign_quantile(row, boundaries, id_col="pcode"):
+    """
+    Assign quintile coded values based on boundaries.
+    """
+    pcode_bounds = boundaries.loc[(row[id_col], row["roll_window"])]
+    value = row["rolling_avg"]
+    if value < pcode_bounds["lower_quintile"]:
+        return -2
+    elif value < pcode_bounds["lower_mid_quintile"]:
+        return -1
+    elif value <= pcode_bounds["upper_mid_quintile"]:
+        return 0
+    elif value < pcode_bounds["upper_quintile"]:
+        return 1
+    else:
+        return 2
+
+
+def save_df(df, sel_date, engine, output_table, id_col="pcode"):
+
+    if df.empty:
+        print(
+            f"No data retrieved from database for {sel_date.strftime('%Y-%m-%d')}"  # noqa
+        )
+        return
+
+    # windows with no non-null values have no average to rank
+    df = df.dropna(subset=["rolling_avg"]).copy()
+
+    print("Computing quantiles...")
+    quantile_boundaries = df.groupby([id_col, "roll_window"])[
+        "rolling_avg"
+    ].agg(
+        lower_quintile=lambda x: np.percentile(x, 20),
+        lower_mid_quintile=lambda x: np.percentile(x, 40),
+        upper_mid_quintile=lambda x: np.percentile(x, 60),
+        upper_quintile=lambda x: np.percentile(x, 80),
+    )
+
+    df["quantile"] = df.apply(
+        lambda row: assign_quantile(row, quantile_boundaries, id_col), axis=1
+    )
+
+    df["valid_date"] = pd.to_datetime(df["valid_date"])
+    df_sel = df[df.valid_date == sel_date.strftime("%Y-%m-%d")]
+
+    if len(df_sel) == 0:
+        print(f"No data available for {sel_date.strftime('%Y-%m-%d')}")
+        return
+
+    print("Writing to database...")
+    df_sel.to_sql(
+        output_table,
+        schema="app",
+        con=engine,
+        if_exists="replace",
+        chunksize=10000,
+        index=False,
+    )
+
+
+def update_quantiles(
+    engine,
+    roll_windows=ROLL_WINDOWS,
+    table_name="floodscan_exposure",
+    table_name_regions="floodscan_exposure_regions",
+    target_date=None,
+):
+    """
+    Update the quantile tables for a date, by default the latest date in the
+    exposure table.
+
+    Parameters
+    ----------
+    engine : Engine
+        SQLAlchemy database engine, with write access
+    roll_windows : list, optional
+        Rolling windows (in days) to compute quantiles for
+    table_name : str, optional
+        Name of the admin exposure table
+    table_name_regions : str, optional
+        Name of the region exposure table
+    target_date : datetime, optional
+        Date to compute quantiles as of. Defaults to the latest date in
+        `table_name`
+
+    Returns
+    -------
+    None
+    """
+    with engine.connect() as con:
+        if target_date is None:
+            # We're assuming this date is the same in the `regions` table
+            result = con.execute(
+                text(f"SELECT MAX(valid_date) FROM app.{table_name}")
+            )
+            target_date = result.fetchone()[0]
+
+        print(f"Computing quantiles as of {target_date.strftime('%Y-%m-%d')}")
+        print(
+            "Using rolling averages over "
+            f"{', '.join(str(x) for x in roll_windows)} days"
+        )
+
+        # read each table once, and calculate all windows from it
+        dfs = {}
+        for x in [table_name, table_name_regions]:
+            df_in = database.get_rolling_window_inputs(
+                x,
+                target_date.month,
+                target_date.day,
+                max(roll_windows),
+                con,
+            )
+            dfs[x] = rolling.calculate_rolling_averages(
+                df_in, roll_windows, target_date.month, target_date.day
+            )
+
+    save_df(dfs[table_name], target_date, engine, "quantile")
+    save_df(dfs[table_name_regions], target_date, engine, "quantile_regions")
@@ -1,24 +1,48 @@
+from functools import lru_cache
+
 import numpy as np
 import xarray as xr
 
 
+@lru_cache(maxsize=128)
+def _nearest_index_map(coord: bytes, dtype: str, resolution: float):
+    # equivalent to scipy's interp1d(kind="nearest", fill_value="extrapolate")
+    # over the sorted source coordinate, as used by xarray's interp
+    x = np.frombuffer(coord, dtype=dtype)
+    new_x = np.arange(x.min() - 1, x.max() + 1, resolution)
+    order = np.argsort(x, kind="stable")
+    x_sorted = x[order]
+    bounds = x_sorted[:-1] + np.diff(x_sorted) / 2
+    idx = np.searchsorted(bounds, new_x, side="left").clip(0, len(x) - 1)
+    index_map = order[idx]
+    new_x.setflags(write=False)
+    index_map.setflags(write=False)
+    return new_x, index_map
+
+
 def upsample_dataarray(
     da: xr.DataArray,
     resolution: float = 0.1,
     lat_dim: str = "latitude",
     lon_dim: str = "longitude",
 ) -> xr.DataArray:
-    new_lat = np.arange(
-        da[lat_dim].min() - 1, da[lat_dim].max() + 1, resolution
-    )
-    new_lon = np.arange(
-        da[lon_dim].min() - 1, da[lon_dim].max() + 1, resolution
-    )
-    return da.interp(
-        coords={
-            lat_dim: new_lat,
-            lon_dim: new_lon,
-        },
-        method="nearest",
-        kwargs={"fill_value": "extrapolate"},
-    )
+    """
+    Upsample a DataArray to a regular grid with nearest-neighbour values,
+    extended by 1 degree on each side.
+
+    Gives the same result as `da.interp(method="nearest")` with
+    extrapolation, but the index of the nearest source cell along each axis
+    is only calculated once per source coordinate and resolution, and then
+    applied to all other dimensions (e.g. date, band) in one indexing step.
+    Dask-backed inputs stay lazy.
+    """
+    new_coords = {}
+    indexers = {}
+    for dim in [lat_dim, lon_dim]:
+        coord = np.ascontiguousarray(da[dim].values)
+        new_coords[dim], indexers[dim] = _nearest_index_map(
+            coord.tobytes(), coord.dtype.str, resolution
+        )
+    if not np.issubdtype(da.dtype, np.inexact):
+        da = da.astype(float)
+    return da.isel(indexers).assign_coords(new_coords)
@@ -0,0 +1,88 @@
+from typing import List, Sequence
+
+import numpy as np
+import pandas as pd
+
+
+def calculate_rolling_averages(
+    df: pd.DataFrame,
+    windows: List[int],
+    month: int,
+    day: int,
+    id_cols: Sequence[str] = ("pcode", "adm_level"),
+    date_col: str = "valid_date",
+    value_col: str = "sum",
+) -> pd.DataFrame:
+    """
+    Calculate trailing rolling averages for several windows at once.
+
+    Each series is sorted by date once and a single cumulative sum is used
+    for all windows. Windows are defined in calendar days, so missing dates
+    are excluded from the average rather than shifting the window, and null
+    values are ignored (the same behaviour as `AVG` over a `BETWEEN` date
+    range in SQL).
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Daily values, with columns `id_cols`, `date_col` and `value_col`
+    windows : List[int]
+        Window lengths in days (e.g. [1, 7, 30])
+    month : int
+        Month of the target dates to return
+    day : int
+        Day of month of the target dates to return
+    id_cols : Sequence[str], optional
+        Columns identifying a single time series
+    date_col : str, optional
+        Name of the date column
+    value_col : str, optional
+        Name of the value column
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per series, target date and window, with columns `id_cols`,
+        `date_col`, `roll_window` and `rolling_avg`
+    """
+    id_cols = list(id_cols)
+    out_cols = [*id_cols, date_col, "roll_window", "rolling_avg"]
+    if df.empty:
+        return pd.DataFrame(columns=out_cols)
+
+    df = df.sort_values([*id_cols, date_col], ignore_index=True)
+    dates = pd.to_datetime(df[date_col])
+    days = dates.values.astype("datetime64[D]").astype(np.int64)
+    days = days - days.min()
+    group = df.groupby(id_cols, sort=False, dropna=False).ngroup().to_numpy()
+
+    # offset each series so that one sorted key covers all of them, with a
+    # gap between series wider than the longest window
+    stride = days.max() + max(windows) + 1
+    key = group * stride + days
+
+    # NULL values are left out of both the sum and the count, as with AVG
+    values = df[value_col].to_numpy(dtype=float)
+    is_valid = ~np.isnan(values)
+    csum = np.concatenate([[0.0], np.cumsum(np.where(is_valid, values, 0))])
+    ccount = np.concatenate([[0], np.cumsum(is_valid)])
+    end = np.arange(1, len(df) + 1)
+
+    is_target = ((dates.dt.month == month) & (dates.dt.day == day)).to_numpy()
+    target_idx = np.flatnonzero(is_target)
+    df_target = df.loc[target_idx, [*id_cols, date_col]]
+
+    dfs = []
+    for window in windows:
+        start = np.searchsorted(key, key[target_idx] - (window - 1))
+        total = csum[end[target_idx]] - csum[start]
+        count = ccount[end[target_idx]] - ccount[start]
+        df_window = df_target.copy()
+        df_window["roll_window"] = window
+        with np.errstate(invalid="ignore", divide="ignore"):
+            df_window["rolling_avg"] = np.where(
+                count > 0, total / count, np.nan
+            )
+        dfs.append(df_window)
+
+    return pd.concat(dfs, ignore_index=True)[out_cols]
@@ -0,0 +1,121 @@
+import calendar
+from datetime import datetime
+from typing import Callable, Dict, List, Set, Tuple
+
+# first year of Floodscan data
+FLOODSCAN_START_YEAR = 1998
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """
+    Parse a shard string "i/n" into the (zero-based) shard index and number
+    of shards.
+    """
+    try:
+        index, n_shards = (int(x) for x in shard.split("/"))
+    except ValueError:
+        raise ValueError(f"shard must be in the form i/n, not {shard}")
+    if not 0 <= index < n_shards:
+        raise ValueError(f"shard index must be from 0 to {n_shards - 1}")
+    return index, n_shards
+
+
+def get_years(all_dates: bool = False, as_of: datetime = None) -> List[int]:
+    """
+    Get years to shard over: all Floodscan years, or only the year of
+    `as_of` (default today)
+    """
+    this_year = (as_of or datetime.today()).year
+    if all_dates:
+        return list(range(FLOODSCAN_START_YEAR, this_year + 1))
+    return [this_year]
+
+
+def assign_shards(weights: Dict, n_shards: int) -> List[List]:
+    """
+    Deterministically assign weighted work units to shards, so that the
+    total weight of each shard is as even as possible.
+
+    Units are assigned heaviest first, each to the shard with the least
+    total weight so far (ties broken by unit key, then shard index), so
+    every job computes the same assignment.
+
+    Parameters
+    ----------
+    weights : Dict
+        Weight of each work unit, keyed by a sortable unit key
+    n_shards : int
+        Number of shards
+
+    Returns
+    -------
+    List[List]
+        Unit keys assigned to each shard
+    """
+    shards = [[] for _ in range(n_shards)]
+    loads = [0] * n_shards
+    for unit in sorted(weights, key=lambda x: (-weights[x], x)):
+        shard = min(range(n_shards), key=lambda x: (loads[x], x))
+        shards[shard].append(unit)
+        loads[shard] += weights[unit]
+    return shards
+
+
+def get_shard_units(
+    iso3s: List[str],
+    years: List[int],
+    shard: str,
+    get_grid_size: Callable[[str], int],
+    as_of: datetime = None,
+) -> Dict[str, Set[int]]:
+    """
+    Get the country-year work units for a shard.
+
+    Each unit is weighted by the size of the country's grid and the number
+    of days in the year (up to `as_of`), so that shards take similar times.
+    All jobs must use the same `as_of` (and years) to get the same
+    assignment, so it should be fixed when the jobs are started, rather
+    than left to default to the date each job runs.
+
+    Parameters
+    ----------
+    iso3s : List[str]
+        ISO3 codes of all countries
+    years : List[int]
+        All years to process
+    shard : str
+        Shard, in the form "i/n" (zero-based)
+    get_grid_size : Callable[[str], int]
+        Function returning the number of grid cells for an ISO3 code
+    as_of : datetime, optional
+        Reference date for the weight of the current year. Defaults to
+        today
+
+    Returns
+    -------
+    Dict[str, Set[int]]
+        Years to process for each country in this shard
+    """
+    index, n_shards = parse_shard(shard)
+    as_of = as_of or datetime.today()
+    weights = {}
+    for iso3 in iso3s:
+        grid_size = get_grid_size(iso3)
+        for year in years:
+            if year == as_of.year:
+                n_days = as_of.timetuple().tm_yday
+            else:
+                n_days = 366 if calendar.isleap(year) else 365
+            weights[(iso3, year)] = grid_size * n_days
+    units = {}
+    for iso3, year in assign_shards(weights, n_shards)[index]:
+        units.setdefault(iso3, set()).add(year)
+    print(f"shard {shard}: {sorted(units.items())}")
+    return units
+
+
+def filter_to_years(
+    blob_names: List[str], years: Set[int], get_date: Callable
+) -> List[str]:
+    """Filter blob names to those with dates in the given years"""
+    return [x for x in blob_names if get_date(x).year in years]